@@ -1,58 +1,173 @@
 import os
 import logging
+import logging.handlers
 import asyncio
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import mmap
+import queue
 import shutil
+import socket
+import subprocess
+import sys
+import threading
 import time
 import re
+import secrets
+import struct
+import zipfile
+import zlib
+from typing import NamedTuple
+import httpx
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram.request import HTTPXRequest
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+
+logger = logging.getLogger(__name__)
+_LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+class _LogFormatter(logging.Formatter):
+    """Formatter that renders the date and time once per second, not per record"""
+    
+    def __init__(self, fmt=_LOG_FORMAT):
+        super().__init__(fmt)
+        self._second = None
+        self._second_text = ''
+    
+    def formatTime(self, record, datefmt=None):
+        # Same output as the default asctime, with localtime/strftime only on a new second
+        second = int(record.created)
+        if second != self._second:
+            self._second = second
+            self._second_text = time.strftime(self.default_time_format, self.converter(record.created))
+        return self.default_msec_format % (self._second_text, record.msecs)
 
 # ===== CONFIGURATION =====
 class Config:
     # Bot configuration
     BOT_TOKEN = os.environ.get('BOT_TOKEN', 'your_bot_token_here')
+    # Telegram echoes this in a header on every webhook call; the secret is re-registered
+    # on each start, so a fresh random one works when none is configured
+    WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
     
     # File handling configuration
     MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
     MAX_FILES_PER_USER = 100
     TEMP_DIR = "temp_files"
     
+    # Session configuration
+    SESSION_TTL = 60 * 60  # idle sessions and their files are dropped after an hour
+    SESSION_SWEEP_INTERVAL = 5 * 60
+    MAX_SESSIONS = 10_000  # past this, the least recently seen idle session is dropped
+    
+    # Archive jobs (creation or extraction) allowed to run at once across all users
+    MAX_PARALLEL_JOBS = int(os.environ.get('MAX_PARALLEL_JOBS', os.cpu_count() or 1))
+    
     # Archive configuration
     SUPPORTED_ARCHIVE_FORMATS = {
+        'tar.zst': 'Zstandard TAR',
         'zip': 'ZIP Archive',
         '7z': '7-Zip Archive', 
         'tar': 'TAR Archive',
         'tar.gz': 'GZipped TAR'
     }
-    
-    EXTRACTABLE_ARCHIVES = {
-        'apk', 'zip', '7z', 'tar', 'tar.gz', 'gz'
-    }
 
 # ===== UTILITIES =====
+_UNSAFE_FILENAME_CHARS = re.compile(r'[^\w\.-]')
+_SIZE_UNITS = ("B", "KB", "MB", "GB")
+_log_listener = None
+
 class Utils:
     @staticmethod
     def ensure_directory(directory):
         """Create directory if it doesn't exist"""
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+        os.makedirs(directory, exist_ok=True)
 
     @staticmethod
     def cleanup_old_files(directory, max_age_hours=24):
         """Clean up files older than max_age_hours"""
-        if not os.path.exists(directory):
-            return
+        # Integer nanoseconds, so each file is a single int comparison against the cutoff
+        cutoff_ns = time.time_ns() - int(max_age_hours * 3600 * 1_000_000_000)
+        
+        # Files live in per-user subdirectories, which outlive the in-memory sessions
+        # across restarts, so walk the whole tree; scandir entries carry their file
+        # type, and stat() on one is cached
+        remaining = collections.Counter()
+        stale_files = []
+        walked_dirs = []
+        pending_dirs = [directory]
+        while pending_dirs:
+            current_dir = pending_dirs.pop()
+            # A missing directory (TEMP_DIR before first use, or a subdirectory removed
+            # mid-walk) just has nothing to clean, no need to stat it up front
+            try:
+                entries = os.scandir(current_dir)
+            except FileNotFoundError:
+                continue
+            walked_dirs.append(current_dir)
+            with entries:
+                for entry in entries:
+                    remaining[current_dir] += 1
+                    if entry.is_dir(follow_symlinks=False):
+                        pending_dirs.append(entry.path)
+                    elif (entry.is_file(follow_symlinks=False)
+                          and entry.stat(follow_symlinks=False).st_ctime_ns < cutoff_ns):
+                        stale_files.append((current_dir, entry.path))
+        
+        def remove(path):
+            try:
+                os.remove(path)
+                return True
+            except OSError:
+                return False
+        
+        # unlink releases the GIL, so several in flight overlap their filesystem latency
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+            removed = pool.map(remove, [path for _, path in stale_files])
+            for (parent, _), was_removed in zip(stale_files, removed):
+                if was_removed:
+                    remaining[parent] -= 1
         
-        current_time = time.time()
-        for filename in os.listdir(directory):
-            file_path = os.path.join(directory, filename)
-            if os.path.isfile(file_path):
-                file_age = current_time - os.path.getctime(file_path)
-                if file_age > max_age_hours * 3600:
-                    try:
-                        os.remove(file_path)
-                    except:
-                        pass
+        # Subdirectories left empty go too; walking the discovery order backwards visits
+        # children before parents, and the counts stand in for listing each one again
+        for path in reversed(walked_dirs[1:]):
+            if remaining[path] == 0:
+                try:
+                    os.rmdir(path)
+                    remaining[os.path.dirname(path)] -= 1
+                except OSError:
+                    pass
+
+    @staticmethod
+    def setup_logging(level=logging.INFO):
+        """Log through a queue so slow stderr never blocks the event loop"""
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(_LogFormatter())
+        
+        # Calling this again replaces the previous setup rather than stacking another
+        # handler (and another write per record) on the root logger
+        global _log_listener
+        root = logging.getLogger()
+        if _log_listener is not None:
+            _log_listener.stop()
+            atexit.unregister(_log_listener.stop)
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        
+        # Records are only enqueued on the calling thread; the listener thread writes them
+        log_queue = queue.Queue(-1)
+        _log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+        root.setLevel(level)
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        # httpx logs every Bot API request (each long poll included) at INFO
+        logging.getLogger('httpx').setLevel(logging.WARNING)
+        _log_listener.start()
+        atexit.register(_log_listener.stop)
+        return _log_listener
 
     @staticmethod
     def format_file_size(size_bytes):
@@ -60,21 +175,211 @@ class Utils:
         if size_bytes == 0:
             return "0 B"
         
-        size_names = ["B", "KB", "MB", "GB"]
-        i = 0
-        while size_bytes >= 1024 and i < len(size_names) - 1:
-            size_bytes /= 1024.0
-            i += 1
+        # Each unit is 2**10 of the previous one, so the bit length picks it directly
+        i = min((size_bytes.bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+        return f"{size_bytes / (1 << (10 * i)):.2f} {_SIZE_UNITS[i]}"
+
+    @staticmethod
+    def unique_file_name(existing, counters, filename):
+        """Return filename, suffixed if it is already in the existing set"""
+        if filename not in existing:
+            return filename
         
-        return f"{size_bytes:.2f} {size_names[i]}"
+        # Resume from the last suffix handed out for this name instead of probing from _1
+        name, ext = os.path.splitext(filename)
+        counter = counters.get(filename, 1)
+        candidate = f"{name}_{counter}{ext}"
+        while candidate in existing:
+            counter += 1
+            candidate = f"{name}_{counter}{ext}"
+        counters[filename] = counter + 1
+        return candidate
+
+    @staticmethod
+    def read_file(file_path):
+        """Read a whole file as bytes"""
+        with open(file_path, 'rb') as f:
+            return f.read()
 
     @staticmethod
     def safe_filename(filename):
         """Make filename safe by removing special characters"""
-        filename = re.sub(r'[^\w\.-]', '_', filename)
-        return filename
+        # Most names are already safe; search stops at the first offending character
+        if _UNSAFE_FILENAME_CHARS.search(filename) is None:
+            return filename
+        return _UNSAFE_FILENAME_CHARS.sub('_', filename)
+
+# ===== FILE ENTRIES =====
+class FileEntry(NamedTuple):
+    """A stored or extracted file; a tuple is lighter than a dict per file"""
+    name: str
+    path: str
+    size: int
 
 # ===== ARCHIVE MANAGER =====
+# Optional ISA-L backend: SIMD DEFLATE/CRC32, several times faster than stock zlib
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+_stdlib_get_compressor = zipfile._get_compressor
+
+def _isal_get_compressor(compress_type, compresslevel=None):
+    """zipfile compressor factory that hands DEFLATE streams to ISA-L"""
+    if compress_type != zipfile.ZIP_DEFLATED:
+        return _stdlib_get_compressor(compress_type, compresslevel)
+    
+    # ISA-L only knows levels 0-3, so clamp zlib-style levels into that range
+    if compresslevel is None:
+        level = isal_zlib.ISAL_DEFAULT_COMPRESSION
+    else:
+        level = min(compresslevel, isal_zlib.ISAL_BEST_COMPRESSION)
+    return isal_zlib.compressobj(level, isal_zlib.DEFLATED, -15)
+
+if isal_zlib is not None:
+    zipfile._get_compressor = _isal_get_compressor
+
+# Optional xxHash for fingerprinting archives; blake2b is the stdlib fallback
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Optional libarchive backend: one in-process reader for zip/tar/rar/cpio/iso
+try:
+    import libarchive
+except (ImportError, OSError, AttributeError):  # bindings present but no C library
+    libarchive = None
+
+# Copy payloads in 1 MiB chunks rather than the 8-16 KiB library defaults
+_COPY_BUFSIZE = 1 << 20
+
+# CPUs this process may run on; in a container cpu_count() reports the whole host
+_USABLE_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+
+# Uncompressed bytes a ZIP job may have in flight on its deflate threads, since
+# compressed blocks are held in memory until the writer reaches them
+_DEFLATE_WINDOW_BYTES = 64 << 20
+
+# Payloads that are already compressed; DEFLATE only burns CPU on these
+_INCOMPRESSIBLE_EXTENSIONS = frozenset({
+    '.apk', '.zip', '.7z', '.rar', '.gz', '.bz2', '.xz', '.zst',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp',
+    '.mp4', '.mkv', '.mov', '.webm', '.mp3', '.m4a', '.ogg'
+})
+
+# Extension tables used to classify uploads
+_EXTRACTABLE_EXTENSIONS = frozenset({'.apk', '.zip', '.7z', '.tar', '.gz', '.rar', '.zst'})
+_COMPOUND_ARCHIVE_EXTENSIONS = ('.tar.gz', '.tar.bz2', '.tar.xz', '.tar.zst')
+
+# Magic numbers for archives whose names don't reveal what they are
+_ARCHIVE_SIGNATURES = (
+    (b'PK\x03\x04', 'zip'),
+    (b'PK\x05\x06', 'zip'),
+    (b'7z\xbc\xaf\x27\x1c', '7z'),
+    (b'\x28\xb5\x2f\xfd', 'zst'),
+    (b'\x1f\x8b', 'gz'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'Rar!\x1a\x07', 'rar'),
+)
+_TAR_MAGIC_OFFSET = 257
+
+# Recently extracted archives, keyed by (content digest, user temp dir)
+_EXTRACTION_CACHE = collections.OrderedDict()
+_EXTRACTION_CACHE_SIZE = 32
+
+# Precompiled ZIP records (PKWARE APPNOTE 4.3.7, 4.3.12, 4.3.16) for the fast writer
+_ZIP_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+_ZIP_CENTRAL_HEADER = struct.Struct('<4sBBBBHHHHIIIHHHHHII')
+_ZIP_END_RECORD = struct.Struct('<4sHHHHIIH')
+_ZIP_VERSION = 20
+_ZIP_CREATE_SYSTEM = 0 if os.name == 'nt' else 3
+
+def _init_archive_worker():
+    """Log straight to stderr in pool workers, the parent's queue listener doesn't run there"""
+    handler = logging.StreamHandler()
+    handler.setFormatter(_LogFormatter())
+    logging.getLogger().handlers[:] = [handler]
+
+def _new_process_pool():
+    return concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                                  initializer=_init_archive_worker)
+
+# Archive codecs are CPU-bound, so they run in worker processes off the event loop
+_PROCESS_POOL = _new_process_pool()
+
+def _replace_process_pool(broken):
+    """Swap in a fresh pool once a worker died, unless another job already did"""
+    global _PROCESS_POOL
+    if _PROCESS_POOL is broken:
+        _PROCESS_POOL = _new_process_pool()
+        broken.shutdown(wait=False)
+
+# Extraction and hashing mostly wait on disk or run in C with the GIL released, so
+# threads suffice; a pool of their own keeps them from starving the short
+# filesystem calls handlers make through asyncio.to_thread
+_ARCHIVE_THREADS = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count(),
+                                                         thread_name_prefix='archive')
+
+# Admission control in front of both pools, so a burst of jobs waits on the loop instead
+# of queueing pickled file lists and spawning deflate threads; created on first use so
+# the semaphore belongs to the running loop
+_archive_jobs = None
+
+def _archive_job_slot():
+    """Return the semaphore that bounds concurrent archive jobs"""
+    global _archive_jobs
+    if _archive_jobs is None:
+        _archive_jobs = asyncio.Semaphore(Config.MAX_PARALLEL_JOBS)
+    return _archive_jobs
+
+class _FilePrefetcher:
+    """Read files on a background thread so disk reads overlap compression"""
+    
+    def __init__(self, paths, depth=4):
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(paths,), daemon=True)
+        self._thread.start()
+    
+    def _put(self, item):
+        """Queue an item, giving up if the consumer has gone away"""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def _run(self, paths):
+        try:
+            for path in paths:
+                with open(path, 'rb', buffering=0) as src:
+                    while True:
+                        chunk = src.read(_COPY_BUFSIZE)
+                        # An empty chunk marks the end of the current file
+                        if not self._put(chunk) or not chunk:
+                            break
+        except OSError as e:
+            self._put(e)
+    
+    def chunks(self):
+        """Yield the chunks of the next file, in order"""
+        while True:
+            chunk = self._queue.get()
+            if isinstance(chunk, OSError):
+                raise chunk
+            if not chunk:
+                return
+            yield chunk
+    
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
 class ArchiveManager:
     @staticmethod
     def get_supported_formats():
@@ -84,159 +389,837 @@ class ArchiveManager:
     @staticmethod
     def can_extract_archive(filename):
         """Check if file can be extracted"""
-        extractable_extensions = {'.apk', '.zip', '.7z', '.tar', '.gz', '.tar.gz', '.rar'}
-        file_ext = os.path.splitext(filename.lower())[1]
-        return file_ext in extractable_extensions
+        return ArchiveManager._is_archive_suffix(ArchiveManager._archive_suffix(filename))
     
     @staticmethod
     def is_archive_file(filename):
         """Check if file is an archive"""
-        archive_extensions = {'.zip', '.7z', '.tar', '.gz', '.tar.gz', '.rar', '.apk'}
-        file_ext = os.path.splitext(filename.lower())[1]
-        return file_ext in archive_extensions
+        # Every archive extension we recognise is also one we can extract
+        return ArchiveManager._is_archive_suffix(ArchiveManager._archive_suffix(filename))
+    
+    @staticmethod
+    def _archive_suffix(filename):
+        """Lowercased last two extensions, enough to recognise .tar.gz and friends"""
+        dot = filename.rfind('.')
+        if dot <= 0:
+            return ''
+        previous = filename.rfind('.', 0, dot)
+        return filename[previous if previous >= 0 else dot:].lower()
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def _is_archive_suffix(suffix):
+        """Check a suffix against the archive extensions; cached per extension, not per file name"""
+        return (suffix.endswith(_COMPOUND_ARCHIVE_EXTENSIONS)
+                or suffix[suffix.rfind('.'):] in _EXTRACTABLE_EXTENSIONS)
+    
+    @staticmethod
+    def sniff_archive_format(path):
+        """Detect archive format from the file's magic bytes"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        # Size and mtime are part of the key so a reused path is sniffed again
+        return ArchiveManager._sniff_archive_format(path, st.st_size, st.st_mtime_ns)
     
     @staticmethod
-    async def compile_archive(files, output_path, format_type):
+    @functools.lru_cache(maxsize=128)
+    def _sniff_archive_format(path, size, mtime_ns):
+        """Match the file header against known archive signatures"""
+        try:
+            with open(path, 'rb') as f:
+                head = f.read(_TAR_MAGIC_OFFSET + 5)
+        except OSError:
+            return None
+        
+        for signature, archive_format in _ARCHIVE_SIGNATURES:
+            if head.startswith(signature):
+                return archive_format
+        if head[_TAR_MAGIC_OFFSET:] == b'ustar':
+            return 'tar'
+        return None
+    
+    @staticmethod
+    async def compile_archive(files, output_path, format_type='tar.zst'):
         """Compile files into an archive"""
         try:
-            if format_type == 'zip':
-                return await ArchiveManager._create_zip(files, output_path)
-            elif format_type == '7z':
-                return await ArchiveManager._create_7z(files, output_path)
-            elif format_type == 'tar':
-                return await ArchiveManager._create_tar(files, output_path)
-            elif format_type == 'tar.gz':
-                return await ArchiveManager._create_tar_gz(files, output_path)
-            else:
+            creator = _ARCHIVE_CREATORS.get(format_type)
+            if creator is None:
                 return False
-        except Exception as e:
-            print(f"Error creating archive: {e}")
+            
+            loop = asyncio.get_running_loop()
+            async with _archive_job_slot():
+                pool = _PROCESS_POOL
+                try:
+                    return await loop.run_in_executor(pool, creator, files, output_path)
+                except concurrent.futures.process.BrokenProcessPool:
+                    # A killed worker (e.g. by the OOM killer) leaves the pool unusable for
+                    # good; replace it and retry once, a second failure is reported below
+                    logger.warning("Archive worker pool broke, restarting it")
+                    _replace_process_pool(pool)
+                    return await loop.run_in_executor(_PROCESS_POOL, creator, files, output_path)
+        except Exception:
+            logger.exception("Error creating %s archive %s", format_type, output_path)
             return False
     
     @staticmethod
-    async def _create_zip(files, output_path):
+    def _create_zip(files, output_path):
         """Create ZIP archive"""
         try:
-            import zipfile
-            with zipfile.ZipFile(output_path, 'w') as zipf:
-                for file_info in files:
-                    arcname = os.path.basename(file_info['path'])
-                    zipf.write(file_info['path'], arcname)
+            entries = []
+            for path in [f.path for f in files]:
+                arcname = os.path.basename(path)
+                stored = os.path.splitext(arcname)[1].lower() in _INCOMPRESSIBLE_EXTENSIONS
+                entries.append((path, arcname, os.stat(path), stored))
+            
+            # The layout is known up front, so unless zip64 records are needed
+            # every header can be packed directly instead of going through ZipInfo
+            total_size = sum(st.st_size for _, _, st, _ in entries)
+            if total_size * 1.05 < zipfile.ZIP64_LIMIT and len(entries) < zipfile.ZIP_FILECOUNT_LIMIT:
+                ArchiveManager._write_zip32(entries, output_path)
+            else:
+                ArchiveManager._write_zipfile(entries, output_path)
             return True
-        except Exception as e:
-            print(f"Error creating ZIP: {e}")
+        except Exception:
+            logger.exception("Error creating ZIP %s", output_path)
             return False
     
     @staticmethod
-    async def _create_7z(files, output_path):
+    def _write_zip32(entries, output_path):
+        """Write a ZIP without zip64 records from precompiled header structs"""
+        central_directory = []
+        
+        # DEFLATE releases the GIL, so members are compressed on threads ahead of
+        # the writer, a bounded window at a time to cap memory; stored payloads are spliced.
+        # Up to MAX_PARALLEL_JOBS of these run at once, so they share the CPUs between them
+        workers = max(1, _USABLE_CPUS // Config.MAX_PARALLEL_JOBS)
+        deflate_entries = collections.deque((path, st.st_size) for path, _, st, stored in entries if not stored)
+        pending = collections.deque()
+        in_flight = 0
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            def fill_window():
+                nonlocal in_flight
+                # Always keep one member going, however large, so the writer never stalls
+                while deflate_entries and len(pending) < workers and (
+                        not pending or in_flight + deflate_entries[0][1] <= _DEFLATE_WINDOW_BYTES):
+                    path, size = deflate_entries.popleft()
+                    pending.append((pool.submit(ArchiveManager._deflate_file, path), size))
+                    in_flight += size
+            
+            fill_window()
+            
+            with open(output_path, 'wb') as out:
+                for path, arcname, st, stored in entries:
+                    name = arcname.encode('utf-8')
+                    flags = 0 if name.isascii() else 0x800  # bit 11: UTF-8 name
+                    method = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+                    dos_time, dos_date = ArchiveManager._dos_timestamp(st.st_mtime)
+                    offset = out.tell()
+                    
+                    if stored:
+                        with open(path, 'rb') as src:
+                            size = compressed_size = os.fstat(src.fileno()).st_size
+                            crc = ArchiveManager._file_crc32(src, size)
+                            out.write(_ZIP_LOCAL_HEADER.pack(
+                                b'PK\x03\x04', _ZIP_VERSION, flags, method, dos_time, dos_date,
+                                crc, compressed_size, size, len(name), 0))
+                            out.write(name)
+                            out.flush()
+                            ArchiveManager._splice(src, out, size)
+                    else:
+                        future, reserved = pending.popleft()
+                        crc, size, compressed_size, blocks = future.result()
+                        in_flight -= reserved
+                        fill_window()
+                        out.write(_ZIP_LOCAL_HEADER.pack(
+                            b'PK\x03\x04', _ZIP_VERSION, flags, method, dos_time, dos_date,
+                            crc, compressed_size, size, len(name), 0))
+                        out.write(name)
+                        out.writelines(blocks)
+                    
+                    central_directory.append(_ZIP_CENTRAL_HEADER.pack(
+                        b'PK\x01\x02', _ZIP_VERSION, _ZIP_CREATE_SYSTEM, _ZIP_VERSION, 0,
+                        flags, method, dos_time, dos_date, crc, compressed_size, size,
+                        len(name), 0, 0, 0, 0, (st.st_mode & 0xFFFF) << 16, offset) + name)
+                
+                directory_offset = out.tell()
+                out.writelines(central_directory)
+                directory_size = out.tell() - directory_offset
+                out.write(_ZIP_END_RECORD.pack(
+                    b'PK\x05\x06', 0, 0, len(central_directory), len(central_directory),
+                    directory_size, directory_offset, 0))
+    
+    @staticmethod
+    def _deflate_file(path):
+        """Raw-DEFLATE a file, returning (crc, size, compressed size, blocks)"""
+        compressobj = isal_zlib.compressobj if isal_zlib is not None else zlib.compressobj
+        crc32 = isal_zlib.crc32 if isal_zlib is not None else zlib.crc32
+        
+        # Favour speed over size, the archive is sent over the network anyway
+        compressor = compressobj(1, zlib.DEFLATED, -15)
+        crc = size = compressed_size = 0
+        blocks = []
+        with open(path, 'rb') as src:
+            for chunk in iter(lambda: src.read(_COPY_BUFSIZE), b''):
+                crc = crc32(chunk, crc)
+                size += len(chunk)
+                blocks.append(compressor.compress(chunk))
+        blocks.append(compressor.flush())
+        return crc, size, sum(map(len, blocks)), blocks
+    
+    @staticmethod
+    def _dos_timestamp(mtime):
+        """Convert an mtime to ZIP's (time, date) words, clamped to 1980-2107"""
+        t = time.localtime(mtime)
+        if t.tm_year < 1980:
+            return 0, (1 << 5) | 1
+        if t.tm_year > 2107:
+            return (23 << 11) | (59 << 5) | 29, (127 << 9) | (12 << 5) | 31
+        return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+                ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+    
+    @staticmethod
+    def _write_zipfile(entries, output_path):
+        """Write a ZIP through zipfile, which handles zip64 for very large archives"""
+        prefetcher = _FilePrefetcher([path for path, _, _, stored in entries if not stored])
+        try:
+            # Timestamps are clamped like the fast writer instead of raising on pre-1980 mtimes
+            with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True,
+                                 compresslevel=1, strict_timestamps=False) as zipf:
+                for path, arcname, st, stored in entries:
+                    zinfo = zipfile.ZipInfo.from_file(path, arcname, strict_timestamps=False)
+                    if stored:
+                        zinfo.compress_type = zipfile.ZIP_STORED
+                        ArchiveManager._write_stored_entry(zipf, zinfo, path)
+                        continue
+                    zinfo.compress_type = zipfile.ZIP_DEFLATED
+                    zinfo._compresslevel = 1
+                    with zipf.open(zinfo, 'w') as dst:
+                        for chunk in prefetcher.chunks():
+                            dst.write(chunk)
+        finally:
+            prefetcher.close()
+    
+    @staticmethod
+    def _write_stored_entry(zipf, zinfo, path):
+        """Append an uncompressed entry, copying its payload kernel-side"""
+        with open(path, 'rb') as src:
+            size = os.fstat(src.fileno()).st_size
+            zinfo.file_size = zinfo.compress_size = size
+            zinfo.CRC = ArchiveManager._file_crc32(src, size)
+            
+            # Same bookkeeping as ZipFile.open(zinfo, 'w'), minus the Python-side copy
+            zinfo.header_offset = zipf.fp.tell()
+            zipf._writecheck(zinfo)
+            zipf._didModify = True
+            zipf.fp.write(zinfo.FileHeader())
+            zipf.fp.flush()
+            ArchiveManager._splice(src, zipf.fp, size)
+            
+            zipf.filelist.append(zinfo)
+            zipf.NameToInfo[zinfo.filename] = zinfo
+            zipf.start_dir = zipf.fp.tell()
+    
+    @staticmethod
+    def _file_crc32(src, size):
+        """CRC32 of a whole file, computed over an mmap instead of read() copies"""
+        if size == 0:
+            return 0
+        crc32 = isal_zlib.crc32 if isal_zlib is not None else zlib.crc32
+        with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return crc32(mm)
+    
+    @staticmethod
+    def _splice(src, dst, size):
+        """Append size bytes of src to dst, with sendfile where the OS allows it"""
+        if not sys.platform.startswith('linux'):
+            shutil.copyfileobj(src, dst, _COPY_BUFSIZE)
+            return
+        
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+            if sent == 0:
+                raise OSError(f"Unexpected end of file after {offset} bytes")
+            offset += sent
+        # sendfile moved the descriptor behind the buffered writer's back
+        dst.seek(0, os.SEEK_END)
+    
+    @staticmethod
+    def _create_7z(files, output_path):
         """Create 7Z archive"""
         try:
             import py7zr
-            with py7zr.SevenZipFile(output_path, 'w') as archive:
-                for file_info in files:
-                    archive.write(file_info['path'], os.path.basename(file_info['path']))
+            # LZMA2 preset 3 instead of py7zr's preset 7, fed in 1 MiB blocks
+            # instead of its 32 KiB default
+            filters = [{'id': py7zr.FILTER_LZMA2, 'preset': 3}]
+            with py7zr.SevenZipFile(output_path, 'w', filters=filters, blocksize=_COPY_BUFSIZE) as archive:
+                for path in [f.path for f in files]:
+                    archive.write(path, os.path.basename(path))
             return True
-        except Exception as e:
-            print(f"Error creating 7Z: {e}")
+        except Exception:
+            logger.exception("Error creating 7Z %s", output_path)
             return False
     
     @staticmethod
-    async def _create_tar(files, output_path):
+    def _create_tar(files, output_path):
         """Create TAR archive"""
         try:
             import tarfile
-            with tarfile.open(output_path, 'w') as tar:
-                for file_info in files:
-                    tar.add(file_info['path'], arcname=os.path.basename(file_info['path']))
+            # Without compression nothing transforms the payloads, so headers are packed
+            # here and each file is spliced kernel-side instead of streamed through tarfile
+            with open(output_path, 'wb') as out:
+                for path in [f.path for f in files]:
+                    with open(path, 'rb') as src:
+                        tarinfo = ArchiveManager._tar_info(path, os.fstat(src.fileno()))
+                        out.write(tarinfo.tobuf(tarfile.GNU_FORMAT, tarfile.ENCODING, 'surrogateescape'))
+                        out.flush()
+                        ArchiveManager._splice(src, out, tarinfo.size)
+                        remainder = tarinfo.size % tarfile.BLOCKSIZE
+                        if remainder:
+                            out.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+                
+                # Two zero blocks end the archive, padded to a whole record as tarfile does
+                end = out.tell() + 2 * tarfile.BLOCKSIZE
+                out.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE + (-end % tarfile.RECORDSIZE)))
             return True
-        except Exception as e:
-            print(f"Error creating TAR: {e}")
+        except Exception:
+            logger.exception("Error creating TAR %s", output_path)
             return False
     
     @staticmethod
-    async def _create_tar_gz(files, output_path):
+    def _create_tar_gz(files, output_path):
         """Create TAR.GZ archive"""
         try:
             import tarfile
-            with tarfile.open(output_path, 'w:gz') as tar:
-                for file_info in files:
-                    tar.add(file_info['path'], arcname=os.path.basename(file_info['path']))
+            with ArchiveManager._gzip_writer(output_path) as gz:
+                with tarfile.open(fileobj=gz, mode='w|', format=tarfile.GNU_FORMAT, copybufsize=_COPY_BUFSIZE) as tar:
+                    ArchiveManager._add_tar_entries(tar, files)
             return True
-        except Exception as e:
-            print(f"Error creating TAR.GZ: {e}")
+        except Exception:
+            logger.exception("Error creating TAR.GZ %s", output_path)
             return False
     
+    @staticmethod
+    def _create_tar_zst(files, output_path):
+        """Create TAR.ZST archive"""
+        try:
+            import tarfile
+            import zstandard
+            # threads=-1 lets zstd compress blocks on every available core
+            cctx = zstandard.ZstdCompressor(level=3, threads=-1)
+            with open(output_path, 'wb') as out, cctx.stream_writer(out) as zw:
+                with tarfile.open(fileobj=zw, mode='w|', format=tarfile.GNU_FORMAT, copybufsize=_COPY_BUFSIZE) as tar:
+                    ArchiveManager._add_tar_entries(tar, files)
+            return True
+        except Exception:
+            logger.exception("Error creating TAR.ZST %s", output_path)
+            return False
+    
+    @staticmethod
+    def _add_tar_entries(tar, files):
+        """Append files to an open TAR from a single stat each"""
+        for path in [f.path for f in files]:
+            with open(path, 'rb') as src:
+                tar.addfile(ArchiveManager._tar_info(path, os.fstat(src.fileno())), src)
+    
+    @staticmethod
+    def _tar_info(path, st):
+        """Describe a regular file as a TAR member"""
+        import tarfile
+        # Building TarInfo by hand skips gettarinfo's lstat/uid lookups, and an
+        # integer mtime keeps tarfile from emitting a pax header per entry
+        tarinfo = tarfile.TarInfo(os.path.basename(path))
+        tarinfo.size = st.st_size
+        tarinfo.mtime = int(st.st_mtime)
+        tarinfo.mode = 0o644
+        return tarinfo
+    
+    @staticmethod
+    @contextlib.contextmanager
+    def _gzip_writer(output_path):
+        """Yield a writable gzip stream, compressing on all cores when possible"""
+        threads = os.cpu_count() or 1
+        pigz = shutil.which('pigz')
+        
+        if pigz:
+            with open(output_path, 'wb') as out:
+                proc = subprocess.Popen([pigz, '-p', str(threads), '-c'], stdin=subprocess.PIPE, stdout=out)
+                try:
+                    yield proc.stdin
+                finally:
+                    proc.stdin.close()
+                    returncode = proc.wait()
+                if returncode != 0:
+                    raise OSError(f"pigz exited with status {returncode}")
+        elif isal_zlib is not None:
+            from isal import igzip_threaded
+            with igzip_threaded.open(output_path, 'wb', threads=threads) as gz:
+                yield gz
+        else:
+            import gzip
+            # Level 6 matches pigz; gzip's default of 9 costs far more CPU for little gain
+            with gzip.open(output_path, 'wb', compresslevel=6) as gz:
+                yield gz
+    
     @staticmethod
     async def extract_archive(archive_path, extract_dir):
         """Extract archive files"""
         try:
-            if archive_path.lower().endswith('.7z'):
-                return await ArchiveManager._extract_7z(archive_path, extract_dir)
-            else:
-                return await ArchiveManager._extract_generic(archive_path, extract_dir)
-        except Exception as e:
-            print(f"Error extracting archive: {e}")
+            loop = asyncio.get_running_loop()
+            async with _archive_job_slot():
+                # Users often re-send the same archive; reuse the earlier extraction as
+                # long as its files are still on disk. Keyed per user dir so paths never leak across users
+                digest = await loop.run_in_executor(_ARCHIVE_THREADS, ArchiveManager._file_digest, archive_path)
+                cache_key = (digest, os.path.dirname(os.path.abspath(extract_dir)))
+                cached_files = _EXTRACTION_CACHE.get(cache_key)
+                if cached_files is not None:
+                    if await loop.run_in_executor(_ARCHIVE_THREADS, ArchiveManager._all_exist, cached_files):
+                        _EXTRACTION_CACHE.move_to_end(cache_key)
+                        return list(cached_files)
+                    _EXTRACTION_CACHE.pop(cache_key, None)
+                
+                # Extraction is blocking disk and CPU work, keep it off the event loop
+                extracted_files = await loop.run_in_executor(_ARCHIVE_THREADS, ArchiveManager._extract_by_format,
+                                                             archive_path, extract_dir)
+                
+                if extracted_files:
+                    _EXTRACTION_CACHE[cache_key] = list(extracted_files)
+                    if len(_EXTRACTION_CACHE) > _EXTRACTION_CACHE_SIZE:
+                        _EXTRACTION_CACHE.popitem(last=False)
+                return extracted_files
+        except Exception:
+            logger.exception("Error extracting archive %s", archive_path)
             return []
     
     @staticmethod
-    async def _extract_7z(archive_path, extract_dir):
-        """Extract 7Z archive"""
+    def _all_exist(files):
+        """Check that every file of a cached extraction is still on disk"""
+        return all(os.path.isfile(f.path) for f in files)
+    
+    @staticmethod
+    def forget_extractions(user_dir):
+        """Drop cached extractions under a user directory that is being removed"""
+        user_dir = os.path.abspath(user_dir)
+        for cache_key in [key for key in _EXTRACTION_CACHE if key[1] == user_dir]:
+            del _EXTRACTION_CACHE[cache_key]
+    
+    @staticmethod
+    def _extract_by_format(archive_path, extract_dir):
+        """Route on content rather than the (user supplied) file name"""
+        # Only reached on a cache miss
+        Utils.ensure_directory(extract_dir)
+        archive_format = ArchiveManager.sniff_archive_format(archive_path)
+        if archive_format == '7z':
+            return ArchiveManager._extract_7z(archive_path, extract_dir)
+        if archive_format == 'zst':
+            return ArchiveManager._extract_tar_zst(archive_path, extract_dir)
+        return ArchiveManager._extract_generic(archive_path, extract_dir)
+    
+    @staticmethod
+    def _file_digest(path):
+        """Fingerprint a file's contents, streaming it in 1 MiB chunks"""
+        hasher = xxhash.xxh3_128() if xxhash is not None else hashlib.blake2b()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(_COPY_BUFSIZE), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+    
+    @staticmethod
+    def _extract_7z(archive_path, extract_dir, targets=None):
+        """Extract 7Z archive, optionally only the members named in targets"""
         try:
             import py7zr
+            targets = set(targets) if targets is not None else None
             with py7zr.SevenZipFile(archive_path, 'r') as archive:
-                archive.extractall(extract_dir)
+                # The archive header already knows every name and size
+                members = [m for m in archive.list()
+                           if not m.is_directory and (targets is None or m.filename in targets)]
+                if targets is None:
+                    archive.extractall(extract_dir)
+                else:
+                    archive.extract(path=extract_dir, targets=[m.filename for m in members])
             
-            # Get list of extracted files
             extracted_files = []
-            for root, dirs, files in os.walk(extract_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    extracted_files.append({
-                        'name': file,
-                        'path': file_path,
-                        'size': os.path.getsize(file_path)
-                    })
+            for member in members:
+                extracted_files.append(FileEntry(os.path.basename(member.filename), os.path.join(extract_dir, member.filename), member.uncompressed))
             
             return extracted_files
-        except Exception as e:
-            print(f"Error extracting 7Z: {e}")
+        except Exception:
+            logger.exception("Error extracting 7Z %s", archive_path)
             return []
     
     @staticmethod
-    async def _extract_generic(archive_path, extract_dir):
-        """Extract generic archive using patool"""
+    def _extract_tar_zst(archive_path, extract_dir):
+        """Extract TAR.ZST archive"""
         try:
-            from patoolib import extract_archive
-            extract_archive(archive_path, outdir=extract_dir)
+            import tarfile
+            import zstandard
+            with open(archive_path, 'rb') as f, zstandard.ZstdDecompressor().stream_reader(f) as zr:
+                with tarfile.open(fileobj=zr, mode='r|', copybufsize=_COPY_BUFSIZE) as tar:
+                    return ArchiveManager._extract_tar_members(tar, extract_dir)
+        except Exception:
+            logger.exception("Error extracting TAR.ZST %s", archive_path)
+            return []
+    
+    @staticmethod
+    def _extract_generic(archive_path, extract_dir):
+        """Extract generic archive, using patool for formats stdlib can't read"""
+        try:
+            if libarchive is not None:
+                try:
+                    extracted_files = ArchiveManager._extract_with_libarchive(archive_path, extract_dir)
+                except libarchive.ArchiveError:
+                    extracted_files = []
+                if extracted_files:
+                    return extracted_files
+                # libarchive has no reader for a bare compressed stream such as a lone .gz
+                return ArchiveManager._extract_with_patool(archive_path, extract_dir)
             
-            # Get list of extracted files
-            extracted_files = []
-            for root, dirs, files in os.walk(extract_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    extracted_files.append({
-                        'name': file,
-                        'path': file_path,
-                        'size': os.path.getsize(file_path)
-                    })
+            import tarfile
+            if zipfile.is_zipfile(archive_path):
+                return ArchiveManager._extract_zip(archive_path, extract_dir)
+            if tarfile.is_tarfile(archive_path):
+                with tarfile.open(archive_path, 'r:*', copybufsize=_COPY_BUFSIZE) as tar:
+                    return ArchiveManager._extract_tar_members(tar, extract_dir)
             
-            return extracted_files
-        except Exception as e:
-            print(f"Error extracting generic archive: {e}")
+            return ArchiveManager._extract_with_patool(archive_path, extract_dir)
+        except Exception:
+            logger.exception("Error extracting generic archive %s", archive_path)
             return []
+    
+    @staticmethod
+    def _extract_with_libarchive(archive_path, extract_dir):
+        """Extract archive with libarchive, listing files as they are written"""
+        root = os.path.abspath(extract_dir)
+        extracted_files = []
+        with libarchive.file_reader(archive_path) as archive:
+            for entry in archive:
+                # Only plain files are materialised, and never outside extract_dir
+                if not entry.isfile:
+                    continue
+                file_path = os.path.normpath(os.path.join(root, entry.pathname.lstrip('/')))
+                if not file_path.startswith(root + os.sep):
+                    continue
+                
+                Utils.ensure_directory(os.path.dirname(file_path))
+                size = 0
+                with open(file_path, 'wb') as dst:
+                    # get_blocks defaults to one memory page per read
+                    for block in entry.get_blocks(_COPY_BUFSIZE):
+                        dst.write(block)
+                        size += len(block)
+                
+                extracted_files.append(FileEntry(os.path.basename(file_path), file_path, size))
+        
+        return extracted_files
+    
+    @staticmethod
+    def _extract_with_patool(archive_path, extract_dir):
+        """Extract archive using patool (rar, bare gz)"""
+        from patoolib import extract_archive
+        extract_archive(archive_path, outdir=extract_dir)
+        
+        # patool output is opaque, so walk what it wrote
+        return ArchiveManager._list_extracted_files(extract_dir)
+    
+    @staticmethod
+    def _extract_zip(archive_path, extract_dir):
+        """Extract ZIP/APK archive, listing files from its central directory"""
+        extracted_files = []
+        with zipfile.ZipFile(archive_path, 'r') as zipf:
+            for info in zipf.infolist():
+                if info.is_dir():
+                    continue
+                file_path = zipf.extract(info, extract_dir)
+                extracted_files.append(FileEntry(os.path.basename(file_path), file_path, info.file_size))
+        
+        return extracted_files
+    
+    @staticmethod
+    def _extract_tar_members(tar, extract_dir):
+        """Extract an open TAR member by member, listing regular files as they land"""
+        import tarfile
+        data_filter = getattr(tarfile, 'data_filter', None)
+        if data_filter is not None:
+            tar.extraction_filter = data_filter
+        
+        root = os.path.realpath(extract_dir)
+        extracted_files = []
+        for member in tar:
+            if data_filter is not None:
+                # List the member as the filter rewrites it: absolute names land under root
+                try:
+                    member = data_filter(member, root)
+                except tarfile.FilterError:
+                    continue
+            # Never extract or list anything outside extract_dir
+            file_path = os.path.realpath(os.path.join(root, member.name))
+            if not file_path.startswith(root + os.sep):
+                continue
+            
+            tar.extract(member, root)
+            if member.isfile():
+                extracted_files.append(FileEntry(os.path.basename(file_path), file_path, member.size))
+        
+        return extracted_files
+    
+    @staticmethod
+    def _list_extracted_files(extract_dir):
+        """Get list of extracted files"""
+        extracted_files = []
+        pending_dirs = [extract_dir]
+        while pending_dirs:
+            with os.scandir(pending_dirs.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending_dirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        extracted_files.append(FileEntry(entry.name, entry.path,
+                                                         entry.stat(follow_symlinks=False).st_size))
+        
+        return extracted_files
+
+# Format dispatch table for compile_archive
+_ARCHIVE_CREATORS = {
+    'tar.zst': ArchiveManager._create_tar_zst,
+    'zip': ArchiveManager._create_zip,
+    '7z': ArchiveManager._create_7z,
+    'tar': ArchiveManager._create_tar,
+    'tar.gz': ArchiveManager._create_tar_gz
+}
+
+# ===== SESSION STORE =====
+class SessionStore:
+    """Per-user sessions keyed by user id
+    
+    Sessions point at files on this machine's disk and hold asyncio locks and
+    tasks, so they are kept in-process rather than in an external cache.
+    """
+    
+    def __init__(self):
+        # Least recently seen first, so the oldest sessions are the cheapest to find
+        self._sessions = collections.OrderedDict()
+        self._removals = {}
+        self._last_sweep = time.monotonic()
+    
+    def __contains__(self, user_id):
+        return user_id in self._sessions
+    
+    def __getitem__(self, user_id):
+        return self._sessions[user_id]
+    
+    async def get_or_init(self, user_id: int):
+        """Return the user's session, creating it on first contact"""
+        self._expire_idle()
+        
+        session = self._sessions.get(user_id)
+        if session is None:
+            session = await self.reset(user_id)
+        else:
+            self._sessions.move_to_end(user_id)
+        session['last_seen'] = time.monotonic()
+        return session
+    
+    def _expire_idle(self):
+        """Drop sessions idle past SESSION_TTL, removing their files in the background"""
+        now = time.monotonic()
+        if now - self._last_sweep < Config.SESSION_SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        
+        for user_id, session in list(self._sessions.items()):
+            if now - session['last_seen'] >= Config.SESSION_TTL and not self._is_busy(session):
+                self._evict(user_id, session)
+    
+    def _evict_least_recent(self):
+        """Make room for a new session by dropping the least recently seen idle one"""
+        for user_id, session in self._sessions.items():
+            if not self._is_busy(session):
+                self._evict(user_id, session)
+                return
+    
+    @staticmethod
+    def _is_busy(session):
+        """Sessions with a job running or queued, or an upload in flight, are never idle"""
+        return session['lock'].locked() or bool(session['pending_tasks']) or session['uploads'] > 0
+    
+    def _evict(self, user_id, session):
+        """Forget a session and remove its files in the background"""
+        del self._sessions[user_id]
+        removal = asyncio.create_task(self.remove_tree(session['temp_dir']))
+        self._removals[user_id] = removal
+        removal.add_done_callback(lambda _, user_id=user_id: self._removals.pop(user_id, None))
+    
+    async def reset(self, user_id: int):
+        """Initialize or reinitialize user session"""
+        # Kept with a trailing separator so per-file paths are plain concatenation;
+        # every name appended to it is a sanitized or archive-derived basename
+        user_temp_dir = os.path.join(Config.TEMP_DIR, f"user_{user_id}") + os.sep
+        
+        # A returning user must not have their new directory removed by their old session's expiry
+        removal = self._removals.get(user_id)
+        if removal is not None:
+            await removal
+        await asyncio.to_thread(Utils.ensure_directory, user_temp_dir)
+        
+        session = self._sessions.get(user_id)
+        if session is None:
+            if len(self._sessions) >= Config.MAX_SESSIONS:
+                self._evict_least_recent()
+            session = self._sessions[user_id] = {
+                'files': [],
+                'archive_files': [],
+                'file_lines': [],
+                'archive_lines': [],
+                'total_size': 0,
+                'file_names': None,
+                'name_counters': {},
+                'temp_dir': user_temp_dir,
+                'lock': asyncio.Lock(),
+                'pending_tasks': set(),
+                'uploads': 0,
+                'last_seen': time.monotonic()
+            }
+        else:
+            # Reset in place; running operations and their ordering carry over
+            self._sessions.move_to_end(user_id)
+            session['files'].clear()
+            session['archive_files'].clear()
+            session['file_lines'].clear()
+            session['archive_lines'].clear()
+            session['total_size'] = 0
+            session['file_names'] = None
+            session['name_counters'].clear()
+            session['temp_dir'] = user_temp_dir
+            session['last_seen'] = time.monotonic()
+        return session
+    
+    @staticmethod
+    async def remove_tree(path, keep_root=False):
+        """Delete a session directory, or only its contents, removing extraction directories concurrently"""
+        ArchiveManager.forget_extractions(path)
+        
+        def subdirectories():
+            subdirs = []
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif keep_root:
+                        with contextlib.suppress(OSError):
+                            os.unlink(entry.path)
+            return subdirs
+        
+        try:
+            subdirs = await asyncio.to_thread(subdirectories)
+        except OSError:
+            return
+        # The default executor's size bounds how many trees are unlinked at once
+        await asyncio.gather(*[asyncio.to_thread(shutil.rmtree, d, ignore_errors=True) for d in subdirs])
+        if not keep_root:
+            await asyncio.to_thread(shutil.rmtree, path, ignore_errors=True)
+    
+    @staticmethod
+    def add_file(session, entry):
+        """Store a file, indexing extractable archives, list lines and the total size as they arrive"""
+        # Entries never change once stored, so each list line is formatted exactly once
+        line = f"• {entry.name} ({Utils.format_file_size(entry.size)})"
+        session['files'].append(entry)
+        session['file_lines'].append(line)
+        session['total_size'] += entry.size
+        if ArchiveManager.can_extract_archive(entry.name):
+            session['archive_files'].append(entry)
+            session['archive_lines'].append(line)
 
 # ===== MAIN BOT CLASS =====
 class FileCompilationBot:
+    # Keyboards and static messages only depend on Config, and PTB markups are
+    # immutable, so the getters below build each one once and share it
+    FORMATS_TEXT = "\n".join([f"• **{key.upper()}** - {desc}"
+                              for key, desc in Config.SUPPORTED_ARCHIVE_FORMATS.items()])
+    
+    WELCOME_MESSAGE = """
+🤖 **Advanced File Compiler Bot**
+
+I can compile files into various archive formats AND extract archives like APK, ZIP, 7z, etc!
+
+**Features:**
+• 📦 Create TAR.ZST, ZIP, 7Z, TAR, TAR.GZ archives
+• 📁 Extract APK, ZIP, 7Z, TAR, TAR.ZST files
+• 🖼️ Handle documents, images, videos
+• 🔒 Secure temporary file handling
+
+Use the buttons below to manage your files!
+    """
+    
+    ARCHIVE_OPTIONS_MESSAGE = f"""
+📦 **Available Archive Formats**
+
+{FORMATS_TEXT}
+
+Choose a format to create your archive:
+    """
+    
+    HELP_MESSAGE = f"""
+🤖 **File Compilation Bot - Help**
+
+**How to use:**
+1. Send me files (documents, images, etc.)
+2. Use the buttons to manage your files
+3. Create ZIP or 7Z archives
+4. Download your compiled archive!
+
+**Supported file types:**
+• Documents (PDF, DOC, TXT, etc.)
+• Images (JPG, PNG, etc.)
+• Videos (MP4, AVI, etc.)
+• Other file types
+
+**Archive Support:**
+• Create: TAR.ZST, ZIP, 7Z, TAR, TAR.GZ
+• Extract: APK, ZIP, 7Z, TAR, TAR.GZ, TAR.ZST
+
+**Limits:**
+• Max file size: {Utils.format_file_size(Config.MAX_FILE_SIZE)}
+• Max files per user: {Config.MAX_FILES_PER_USER}
+
+**Commands:**
+/start - Restart the bot and show main menu
+    """
+    
     def __init__(self):
-        self.user_sessions = {}
-        self.setup_directories()
+        self.user_sessions = SessionStore()
+        self._download_client = None
+        
+        # Callback data routing: exact matches first, then prefixes carrying an argument
+        self._callback_routes = {
+            "show_archive_options": self.show_archive_options,
+            "show_extract_options": self.show_extract_options,
+            "extract_all": self.extract_all_request,
+            "list_extractable": self.list_extractable_files,
+            "list_files": self.list_user_files,
+            "clear_files": self.clear_user_files,
+            "show_help": self.show_help_info,
+            "cancel_creation": self.cancel_operation,
+            "cancel_extraction": self.cancel_operation,
+            "back_to_main": self.back_to_main
+        }
+        self._prefix_routes = (
+            ("create_", self.create_archive_request),
+            ("confirm_", self.confirm_request)
+        )
     
-    def setup_directories(self):
+    async def setup_directories(self):
         """Create necessary directories"""
-        Utils.ensure_directory(Config.TEMP_DIR)
-        Utils.cleanup_old_files(Config.TEMP_DIR)
+        await asyncio.to_thread(Utils.ensure_directory, Config.TEMP_DIR)
+        await asyncio.to_thread(Utils.cleanup_old_files, Config.TEMP_DIR)
     
-    def get_main_keyboard(self):
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_main_keyboard():
         """Create the main inline keyboard"""
         keyboard = [
             [InlineKeyboardButton("📦 Create Archive", callback_data="show_archive_options")],
@@ -247,7 +1230,9 @@ class FileCompilationBot:
         ]
         return InlineKeyboardMarkup(keyboard)
     
-    def get_archive_format_keyboard(self):
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_archive_format_keyboard():
         """Create keyboard for archive format selection"""
         supported_formats = ArchiveManager.get_supported_formats()
         keyboard = []
@@ -261,7 +1246,9 @@ class FileCompilationBot:
         keyboard.append([InlineKeyboardButton("⬅️ Back", callback_data="back_to_main")])
         return InlineKeyboardMarkup(keyboard)
     
-    def get_extract_keyboard(self):
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_extract_keyboard():
         """Create keyboard for extraction options"""
         keyboard = [
             [InlineKeyboardButton("📁 Extract All Archives", callback_data="extract_all")],
@@ -270,7 +1257,9 @@ class FileCompilationBot:
         ]
         return InlineKeyboardMarkup(keyboard)
     
-    def get_confirm_keyboard(self, action, format_type=None):
+    @staticmethod
+    @functools.lru_cache(maxsize=32)
+    def get_confirm_keyboard(action, format_type=None):
         """Create confirmation keyboard"""
         if action == "create_archive":
             keyboard = [
@@ -293,7 +1282,9 @@ class FileCompilationBot:
         
         return InlineKeyboardMarkup(keyboard)
     
-    def get_back_keyboard(self):
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_back_keyboard():
         """Create back to main menu keyboard"""
         keyboard = [
             [InlineKeyboardButton("⬅️ Back to Main", callback_data="back_to_main")]
@@ -303,38 +1294,26 @@ class FileCompilationBot:
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Send a message when the command /start is issued."""
         user_id = update.effective_user.id
-        self.initialize_user_session(user_id)
+        await self.user_sessions.reset(user_id)
         
-        welcome_message = """
-🤖 **Advanced File Compiler Bot**
-
-I can compile files into various archive formats AND extract archives like APK, ZIP, 7z, etc!
-
-**Features:**
-• 📦 Create ZIP, 7Z, TAR, TAR.GZ archives
-• 📁 Extract APK, ZIP, 7Z, TAR files
-• 🖼️ Handle documents, images, videos
-• 🔒 Secure temporary file handling
-
-Use the buttons below to manage your files!
-        """
         await update.message.reply_text(
-            welcome_message, 
+            self.WELCOME_MESSAGE,
             parse_mode='Markdown',
             reply_markup=self.get_main_keyboard()
         )
     
-    def initialize_user_session(self, user_id: int):
-        """Initialize or reinitialize user session"""
-        user_temp_dir = os.path.join(Config.TEMP_DIR, f"user_{user_id}")
-        Utils.ensure_directory(user_temp_dir)
-        
-        self.user_sessions[user_id] = {
-            'files': [],
-            'temp_dir': user_temp_dir,
-            'waiting_confirmation': None,
-            'extracted_files': []
-        }
+    def run_in_background(self, user_id: int, coro):
+        """Run a long operation off the update pipeline, one at a time per user"""
+        user_session = self.user_sessions[user_id]
+        
+        async def run_locked():
+            async with user_session['lock']:
+                await coro
+        
+        # Keep a reference so the task isn't garbage collected mid-run
+        task = asyncio.create_task(run_locked())
+        user_session['pending_tasks'].add(task)
+        task.add_done_callback(user_session['pending_tasks'].discard)
     
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle inline keyboard button presses"""
@@ -345,51 +1324,32 @@ Use the buttons below to manage your files!
         data = query.data
         
         # Initialize session if not exists
-        if user_id not in self.user_sessions:
-            self.initialize_user_session(user_id)
-        
-        if data == "show_archive_options":
-            await self.show_archive_options(query)
-        elif data.startswith("create_"):
-            format_type = data.replace("create_", "")
-            await self.create_archive_request(query, format_type)
-        elif data == "show_extract_options":
-            await self.show_extract_options(query)
-        elif data == "extract_all":
-            await self.extract_all_request(query)
-        elif data == "list_extractable":
-            await self.list_extractable_files(query)
-        elif data == "list_files":
-            await self.list_user_files(query)
-        elif data == "clear_files":
-            await self.clear_user_files(query)
-        elif data == "show_help":
-            await self.show_help_info(query)
-        elif data.startswith("confirm_"):
-            if data.startswith("confirm_extract"):
-                await self.confirm_extraction(query, data.replace("confirm_", ""))
-            else:
-                await self.confirm_creation(query, data.replace("confirm_", ""))
-        elif data in ["cancel_creation", "cancel_extraction"]:
-            await self.cancel_operation(query)
-        elif data == "back_to_main":
-            await self.back_to_main(query)
+        await self.user_sessions.get_or_init(user_id)
+        
+        handler = self._callback_routes.get(data)
+        if handler is not None:
+            await handler(query)
+            return
+        
+        for prefix, handler in self._prefix_routes:
+            if data.startswith(prefix):
+                await handler(query, data[len(prefix):])
+                return
+    
+    async def confirm_request(self, query, action):
+        """Start a confirmed creation or extraction"""
+        user_id = query.from_user.id
+        
+        # Archiving can take a while, so answer the update now and finish in a task
+        if action.startswith("extract"):
+            self.run_in_background(user_id, self.confirm_extraction(query, action))
+        else:
+            self.run_in_background(user_id, self.confirm_creation(query, action))
     
     async def show_archive_options(self, query):
         """Show available archive formats"""
-        supported_formats = ArchiveManager.get_supported_formats()
-        formats_text = "\n".join([f"• **{key.upper()}** - {desc}" for key, desc in supported_formats.items()])
-        
-        message = f"""
-📦 **Available Archive Formats**
-
-{formats_text}
-
-Choose a format to create your archive:
-        """
-        
         await query.edit_message_text(
-            message,
+            self.ARCHIVE_OPTIONS_MESSAGE,
             parse_mode='Markdown',
             reply_markup=self.get_archive_format_keyboard()
         )
@@ -397,8 +1357,7 @@ Choose a format to create your archive:
     async def show_extract_options(self, query):
         """Show extraction options"""
         user_id = query.from_user.id
-        archive_files = [f for f in self.user_sessions[user_id]['files'] 
-                        if ArchiveManager.can_extract_archive(f['name'])]
+        archive_files = self.user_sessions[user_id]['archive_files']
         
         message = f"""
 📁 **Archive Extraction**
@@ -429,46 +1388,42 @@ You can:
             )
             return
         
-        # Store the format type for confirmation
-        self.user_sessions[user_id]['waiting_confirmation'] = f"create_{format_type}"
-        
-        file_list = "\n".join([f"• {f['name']}" for f in files])
-        total_size = sum(f['size'] for f in files)
+        file_list = "\n".join([f"• {f.name}" for f in files])
+        total_size = self.user_sessions[user_id]['total_size']
         message = f"""
-📦 **Create {format_type.upper()} Archive**
+📦 Create {format_type.upper()} Archive
 
-**Files to include ({len(files)}):**
+Files to include ({len(files)}):
 {file_list}
 
-**Archive size:** {Utils.format_file_size(total_size)}
+Archive size: {Utils.format_file_size(total_size)}
 
 Are you sure you want to create the {format_type.upper()} archive?
         """
         
+        # Plain text: file names may hold _ or * and would break Markdown parsing
         await query.edit_message_text(
             message,
-            parse_mode='Markdown',
             reply_markup=self.get_confirm_keyboard("create_archive", format_type)
         )
     
     async def extract_all_request(self, query):
         """Handle extract all archives request"""
         user_id = query.from_user.id
-        archive_files = [f for f in self.user_sessions[user_id]['files'] 
-                        if ArchiveManager.can_extract_archive(f['name'])]
+        archive_files = self.user_sessions[user_id]['archive_files']
         
         if not archive_files:
             await query.edit_message_text(
-                "❌ No extractable archives found!\n\nSupported formats: APK, ZIP, 7Z, TAR, TAR.GZ",
+                "❌ No extractable archives found!\n\nSupported formats: APK, ZIP, 7Z, TAR, TAR.GZ, TAR.ZST",
                 reply_markup=self.get_back_keyboard()
             )
             return
         
-        archive_list = "\n".join([f"• {f['name']}" for f in archive_files])
+        archive_list = "\n".join([f"• {f.name}" for f in archive_files])
         message = f"""
-📁 **Extract All Archives**
+📁 Extract All Archives
 
-**Archives to extract ({len(archive_files)}):**
+Archives to extract ({len(archive_files)}):
 {archive_list}
 
 All files from these archives will be extracted and added to your file list.
@@ -478,22 +1433,21 @@ Continue?
         
         await query.edit_message_text(
             message,
-            parse_mode='Markdown',
             reply_markup=self.get_confirm_keyboard("extract_all")
         )
     
     async def list_extractable_files(self, query):
         """List extractable archive files"""
         user_id = query.from_user.id
-        archive_files = [f for f in self.user_sessions[user_id]['files'] 
-                        if ArchiveManager.can_extract_archive(f['name'])]
+        user_session = self.user_sessions[user_id]
+        archive_files = user_session['archive_files']
         
         if not archive_files:
             message = "📭 No extractable archives found.\n\nSend me APK, ZIP, 7Z, or TAR files to extract them!"
         else:
-            archive_list = "\n".join([f"• {f['name']} ({Utils.format_file_size(f['size'])})" for f in archive_files])
+            archive_list = "\n".join(user_session['archive_lines'])
             message = f"""
-📋 **Extractable Archives** ({len(archive_files)} files)
+📋 Extractable Archives ({len(archive_files)} files)
 
 {archive_list}
 
@@ -502,14 +1456,12 @@ Use "Extract All Archives" to extract all of these at once!
         
         await query.edit_message_text(
             message,
-            parse_mode='Markdown',
             reply_markup=self.get_extract_keyboard()
         )
     
     async def confirm_creation(self, query, format_type):
         """Handle confirmed archive creation"""
         user_id = query.from_user.id
-        user_session = self.user_sessions[user_id]
         
         await query.edit_message_text(f"⏳ Creating {format_type.upper()} archive... Please wait.")
         
@@ -517,20 +1469,18 @@ Use "Extract All Archives" to extract all of these at once!
             archive_path = await self.create_archive_file(user_id, format_type)
             
             if archive_path:
-                # Send the archive file
-                with open(archive_path, 'rb') as archive_file:
-                    await query.message.reply_document(
-                        document=archive_file,
-                        filename=f"compiled_files.{format_type}",
-                        caption=f"✅ Your {format_type.upper()} archive is ready!",
-                        reply_markup=self.get_main_keyboard()
-                    )
+                # Send the archive file; PTB buffers the whole upload anyway, so read
+                # it on a worker thread instead of letting InputFile block the loop
+                archive_data = await asyncio.to_thread(Utils.read_file, archive_path)
+                await query.message.reply_document(
+                    document=archive_data,
+                    filename=f"compiled_files.{format_type}",
+                    caption=f"✅ Your {format_type.upper()} archive is ready!",
+                    reply_markup=self.get_main_keyboard()
+                )
                 
                 # Clean up the archive file
-                os.remove(archive_path)
-                
-                # Clear waiting confirmation
-                user_session['waiting_confirmation'] = None
+                await asyncio.to_thread(os.remove, archive_path)
                 
             else:
                 await query.edit_message_text(
@@ -538,8 +1488,8 @@ Use "Extract All Archives" to extract all of these at once!
                     reply_markup=self.get_main_keyboard()
                 )
                 
-        except Exception as e:
-            print(f"Error creating archive: {e}")
+        except Exception:
+            logger.error("Error creating %s archive for user %s", format_type, user_id, exc_info=True)
             await query.edit_message_text(
                 "❌ Error creating archive. Please try again.",
                 reply_markup=self.get_main_keyboard()
@@ -550,6 +1500,8 @@ Use "Extract All Archives" to extract all of these at once!
         user_id = query.from_user.id
         user_session = self.user_sessions[user_id]
         
+        # Edited before the job starts: it takes the confirm button away, so a
+        # second tap can't extract (and add) the same archives again
         await query.edit_message_text("⏳ Extracting archives... Please wait.")
         
         try:
@@ -568,8 +1520,8 @@ Use "Extract All Archives" to extract all of these at once!
                     reply_markup=self.get_main_keyboard()
                 )
                 
-        except Exception as e:
-            print(f"Error extracting archives: {e}")
+        except Exception:
+            logger.error("Error extracting archives for user %s", user_id, exc_info=True)
             await query.edit_message_text(
                 "❌ Error extracting archives. Please try again.",
                 reply_markup=self.get_main_keyboard()
@@ -577,9 +1529,6 @@ Use "Extract All Archives" to extract all of these at once!
     
     async def cancel_operation(self, query):
         """Cancel any pending operation"""
-        user_id = query.from_user.id
-        self.user_sessions[user_id]['waiting_confirmation'] = None
-        
         await query.edit_message_text(
             "Operation cancelled.",
             reply_markup=self.get_main_keyboard()
@@ -595,7 +1544,7 @@ Use "Extract All Archives" to extract all of these at once!
             return None
         
         archive_name = f"compiled_files_{user_id}_{len(files)}files.{format_type}"
-        archive_path = os.path.join(temp_dir, archive_name)
+        archive_path = temp_dir + archive_name
         
         success = await ArchiveManager.compile_archive(files, archive_path, format_type)
         return archive_path if success else None
@@ -603,52 +1552,51 @@ Use "Extract All Archives" to extract all of these at once!
     async def extract_user_archives(self, user_id: int) -> int:
         """Extract all supported archives for a user"""
         user_session = self.user_sessions[user_id]
-        files = user_session['files']
         temp_dir = user_session['temp_dir']
         
-        extractable_files = [f for f in files if ArchiveManager.can_extract_archive(f['name'])]
-        total_extracted = 0
+        # Snapshot, so archives found inside archives wait for the next run
+        extractable_files = list(user_session['archive_files'])
         
-        for archive_file in extractable_files:
-            try:
-                # Create extraction directory
-                extract_dir = os.path.join(temp_dir, f"extracted_{os.path.splitext(archive_file['name'])[0]}")
-                Utils.ensure_directory(extract_dir)
-                
-                # Extract archive
-                extracted_files = await ArchiveManager.extract_archive(archive_file['path'], extract_dir)
-                
-                # Add extracted files to user's file list
-                for extracted_file in extracted_files:
-                    # Check file limit
-                    if len(user_session['files']) >= Config.MAX_FILES_PER_USER:
-                        break
-                    
-                    user_session['files'].append({
-                        'name': extracted_file['name'],
-                        'path': extracted_file['path'],
-                        'size': extracted_file['size']
-                    })
-                    total_extracted += 1
-                
-            except Exception as e:
-                print(f"Error extracting {archive_file['name']}: {e}")
-                continue
+        # Archives extract into separate directories, so run a few at once
+        semaphore = asyncio.Semaphore(4)
+        
+        async def extract_one(archive_file):
+            async with semaphore:
+                try:
+                    # extract_archive creates the directory unless the extraction is cached
+                    extract_dir = f"{temp_dir}extracted_{os.path.splitext(archive_file.name)[0]}"
+                    # Uploads must not be named after the directory once it exists
+                    if user_session['file_names'] is not None:
+                        user_session['file_names'].add(os.path.basename(extract_dir))
+                    return await ArchiveManager.extract_archive(archive_file.path, extract_dir)
+                except Exception:
+                    logger.error("Error extracting %s", archive_file.name, exc_info=True)
+                    return []
         
-        return total_extracted
+        results = await asyncio.gather(*[extract_one(f) for f in extractable_files])
+        
+        # Add extracted files to user's file list in archive order, up to the file limit
+        # less the slots uploads waiting on the lock have already taken
+        room = max(Config.MAX_FILES_PER_USER - len(user_session['files']) - user_session['uploads'], 0)
+        extracted = [f for extracted_files in results for f in extracted_files][:room]
+        for extracted_file in extracted:
+            SessionStore.add_file(user_session, extracted_file)
+        
+        return len(extracted)
 
     async def list_user_files(self, query):
         """List all stored files"""
         user_id = query.from_user.id
-        files = self.user_sessions[user_id]['files']
+        user_session = self.user_sessions[user_id]
+        files = user_session['files']
         
         if not files:
             message = "📭 No files received yet.\n\nSend me some files to get started!"
         else:
-            file_list = "\n".join([f"• {f['name']} ({Utils.format_file_size(f['size'])})" for f in files])
-            total_size = sum(f['size'] for f in files)
+            file_list = "\n".join(user_session['file_lines'])
+            total_size = user_session['total_size']
             message = f"""
-📋 **Your Files** ({len(files)} files, {Utils.format_file_size(total_size)} total)
+📋 Your Files ({len(files)} files, {Utils.format_file_size(total_size)} total)
 
 {file_list}
 
@@ -657,7 +1605,6 @@ Ready to create an archive?
         
         await query.edit_message_text(
             message,
-            parse_mode='Markdown',
             reply_markup=self.get_main_keyboard()
         )
     
@@ -665,14 +1612,15 @@ Ready to create an archive?
         """Clear all stored files"""
         user_id = query.from_user.id
         
-        # Clean up temporary files
-        if user_id in self.user_sessions:
-            temp_dir = self.user_sessions[user_id]['temp_dir']
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir)
+        user_session = self.user_sessions[user_id]
         
-        # Reinitialize session
-        self.initialize_user_session(user_id)
+        # Clean up temporary files, after any archive still being built from them; the
+        # directory itself stays, so reset finds it instead of recreating it
+        async with user_session['lock']:
+            await SessionStore.remove_tree(user_session['temp_dir'], keep_root=True)
+            
+            # Reinitialize session
+            await self.user_sessions.reset(user_id)
         
         await query.edit_message_text(
             "✅ All files cleared!",
@@ -681,35 +1629,8 @@ Ready to create an archive?
     
     async def show_help_info(self, query):
         """Show help information"""
-        help_message = f"""
-🤖 **File Compilation Bot - Help**
-
-**How to use:**
-1. Send me files (documents, images, etc.)
-2. Use the buttons to manage your files
-3. Create ZIP or 7Z archives
-4. Download your compiled archive!
-
-**Supported file types:**
-• Documents (PDF, DOC, TXT, etc.)
-• Images (JPG, PNG, etc.)
-• Videos (MP4, AVI, etc.)
-• Other file types
-
-**Archive Support:**
-• Create: ZIP, 7Z, TAR, TAR.GZ
-• Extract: APK, ZIP, 7Z, TAR, TAR.GZ
-
-**Limits:**
-• Max file size: {Utils.format_file_size(Config.MAX_FILE_SIZE)}
-• Max files per user: {Config.MAX_FILES_PER_USER}
-
-**Commands:**
-/start - Restart the bot and show main menu
-        """
-        
         await query.edit_message_text(
-            help_message,
+            self.HELP_MESSAGE,
             parse_mode='Markdown',
             reply_markup=self.get_back_keyboard()
         )
@@ -738,13 +1659,11 @@ Use the buttons below to manage your files!
         user_id = update.effective_user.id
         
         # Initialize session if not exists
-        if user_id not in self.user_sessions:
-            self.initialize_user_session(user_id)
-        
-        user_session = self.user_sessions[user_id]
+        user_session = await self.user_sessions.get_or_init(user_id)
         
-        # Check file limit
-        if len(user_session['files']) >= Config.MAX_FILES_PER_USER:
+        # Check file limit, counting uploads still in flight; the slot is taken before
+        # the first await, so concurrent uploads can't all pass the check
+        if len(user_session['files']) + user_session['uploads'] >= Config.MAX_FILES_PER_USER:
             await update.message.reply_text(
                 f"❌ Maximum file limit reached ({Config.MAX_FILES_PER_USER} files). "
                 "Please create an archive or clear some files.",
@@ -752,6 +1671,14 @@ Use the buttons below to manage your files!
             )
             return
         
+        user_session['uploads'] += 1
+        try:
+            await self.receive_file(update, user_session)
+        finally:
+            user_session['uploads'] -= 1
+    
+    async def receive_file(self, update: Update, user_session) -> None:
+        """Download an upload into the user's directory and store it"""
         # Get the file
         file_obj = None
         file_name = None
@@ -788,33 +1715,35 @@ Use the buttons below to manage your files!
             )
             return
         
-        # Download file
-        temp_dir = user_session['temp_dir']
-        file_path = os.path.join(temp_dir, file_name)
-        
-        # Ensure unique filename
-        counter = 1
-        original_name = file_name
-        while os.path.exists(file_path):
-            name, ext = os.path.splitext(original_name)
-            file_name = f"{name}_{counter}{ext}"
-            file_path = os.path.join(temp_dir, file_name)
-            counter += 1
-        
         try:
-            await file_obj.download_to_drive(file_path)
-            
-            # Get actual file size
-            actual_size = os.path.getsize(file_path)
-            
-            # Store file info
-            user_session['files'].append({
-                'name': file_name,
-                'path': file_path,
-                'size': actual_size
-            })
+            # The session lock is held from picking the name to storing the file, so
+            # clearing, archive jobs and the user's other uploads wait for the download
+            async with user_session['lock']:
+                temp_dir = user_session['temp_dir']
+                
+                # Ensure unique filename against one cached listing of the user's directory
+                if user_session['file_names'] is None:
+                    # '.' and '..' are never listed but can't be written to either
+                    file_names = set(await asyncio.to_thread(os.listdir, temp_dir))
+                    file_names.update((os.curdir, os.pardir))
+                    user_session['file_names'] = file_names
+                file_names = user_session['file_names']
+                file_name = Utils.unique_file_name(file_names, user_session['name_counters'], file_name)
+                file_names.add(file_name)
+                file_path = temp_dir + file_name
+                
+                # The download counts what it writes, so the stored size needs no stat
+                try:
+                    actual_size = await self.download_file(file_obj, file_path)
+                except Exception:
+                    # The partial file is gone, so a retry can have the name back
+                    file_names.discard(file_name)
+                    raise
+                
+                # Store file info
+                SessionStore.add_file(user_session, FileEntry(file_name, file_path, actual_size))
+                files_count = len(user_session['files'])
             
-            files_count = len(user_session['files'])
             file_type_icon = "📁"
             if ArchiveManager.is_archive_file(file_name):
                 file_type_icon = "📦"
@@ -832,16 +1761,44 @@ Use the buttons below to manage your files!
                 reply_markup=self.get_main_keyboard()
             )
             
-        except Exception as e:
-            print(f"Error downloading file: {e}")
+        except Exception:
+            logger.error("Error downloading %s", file_name, exc_info=True)
             await update.message.reply_text(
                 "❌ Error downloading file. Please try again.",
                 reply_markup=self.get_main_keyboard()
             )
     
+    async def download_file(self, file_obj, file_path):
+        """Stream a Telegram file to disk in 1 MiB chunks instead of buffering it whole, returning its size"""
+        # download_to_drive holds the entire body in memory and writes it from the loop thread
+        if self._download_client is None:
+            self._download_client = httpx.AsyncClient(timeout=httpx.Timeout(30.0, pool=10.0))
+        
+        out = await asyncio.to_thread(open, file_path, 'wb')
+        written = 0
+        try:
+            async with self._download_client.stream('GET', file_obj.file_path) as response:
+                if response.is_error:
+                    # Not raise_for_status: its message carries the URL, and with it the bot token
+                    raise OSError(f"File download failed with HTTP {response.status_code}")
+                async for chunk in response.aiter_bytes(_COPY_BUFSIZE):
+                    await asyncio.to_thread(out.write, chunk)
+                    written += len(chunk)
+        except BaseException:
+            await asyncio.to_thread(out.close)
+            await asyncio.to_thread(os.remove, file_path)
+            raise
+        await asyncio.to_thread(out.close)
+        return written
+    
+    async def shutdown(self):
+        """Release the download connection pool"""
+        if self._download_client is not None:
+            await self._download_client.aclose()
+    
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle errors."""
-        print(f"Exception while handling an update: {context.error}")
+        logger.error("Exception while handling an update", exc_info=context.error)
         
         # Send error message to user
         if update and update.effective_user:
@@ -857,9 +1814,32 @@ Use the buttons below to manage your files!
 # ===== APPLICATION SETUP =====
 async def setup_application():
     """Setup and return the application with all handlers"""
-    application = Application.builder().token(Config.BOT_TOKEN).build()
+    # One pooled client for every API call: enough connections that concurrent
+    # replies don't wait on each other, TCP keepalive so idle ones stay usable,
+    # and write timeouts long enough for archive uploads
+    request = HTTPXRequest(
+        connection_pool_size=256,
+        read_timeout=30.0,
+        write_timeout=30.0,
+        pool_timeout=10.0,
+        media_write_timeout=300.0,
+        socket_options=((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),)
+    )
+    
+    # Process updates concurrently so one user's upload doesn't queue everyone else
+    application = (
+        Application.builder()
+        .token(Config.BOT_TOKEN)
+        .concurrent_updates(True)
+        .request(request)
+        # Stay under Telegram's flood limits, and on a 429 pause every request for
+        # retry_after instead of letting each call retry on its own
+        .rate_limiter(AIORateLimiter(max_retries=2))
+        .build()
+    )
     
     bot = FileCompilationBot()
+    await bot.setup_directories()
     
     # Add handlers
     application.add_handler(CommandHandler("start", bot.start))
@@ -869,69 +1849,86 @@ async def setup_application():
     
     return application, bot
 
+# The handlers only consume messages and button presses; Telegram filters out the
+# rest (edits, channel posts, member updates...) before they are ever sent
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
 async def run_polling():
     """Run the bot in polling mode (for development)"""
-    application, _ = await setup_application()
+    application, bot = await setup_application()
     
-    print("✅ Bot is running successfully in POLLING mode!")
-    await application.run_polling(drop_pending_updates=True)
+    async with application:
+        await application.updater.start_polling(allowed_updates=ALLOWED_UPDATES, drop_pending_updates=True)
+        await application.start()
+        logger.info("Bot is running in polling mode")
+        
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await application.updater.stop()
+            await application.stop()
+            await bot.shutdown()
 
 async def run_webhook(port=10000):
     """Run the bot in webhook mode (for production on Render)"""
-    application, _ = await setup_application()
+    application, bot = await setup_application()
     
     # Auto-detect webhook URL
     service_name = os.environ.get('RENDER_SERVICE_NAME', 'file-compilation-bot')
     webhook_url = f"https://{service_name}.onrender.com"
     
-    # Set webhook
-    await application.bot.set_webhook(
-        url=f"{webhook_url}/{Config.BOT_TOKEN}",
-        drop_pending_updates=True
-    )
-    print(f"✅ Webhook set to: {webhook_url}/{Config.BOT_TOKEN}")
+    logger.info("Starting bot in webhook mode")
     
-    # Start webhook
-    print("🚀 Starting bot in WEBHOOK mode...")
-    
-    # For webhook, we need to keep the application running
-    # In production environments like Render, we'll use the port provided
-    await application.start()
-    print("✅ Bot application started!")
-    
-    # We'll keep the bot running indefinitely
-    print("🔄 Bot is now running and waiting for updates...")
-    
-    # Keep the application running
-    await asyncio.Event().wait()
+    async with application:
+        # Serves the webhook path on the given port and registers it with Telegram;
+        # max_connections is how many updates Telegram may deliver in parallel
+        await application.updater.start_webhook(
+            listen="0.0.0.0",
+            port=port,
+            url_path=Config.BOT_TOKEN,
+            webhook_url=f"{webhook_url}/{Config.BOT_TOKEN}",
+            max_connections=100,
+            allowed_updates=ALLOWED_UPDATES,
+            drop_pending_updates=True,
+            # Requests without the matching header are refused before their body is parsed
+            secret_token=Config.WEBHOOK_SECRET
+        )
+        await application.start()
+        # The path is the bot token, which has no place in the logs
+        logger.info("Webhook set to %s/<token>, waiting for updates", webhook_url)
+        
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await application.updater.stop()
+            await application.stop()
+            await bot.shutdown()
 
 # ===== MAIN ENTRY POINT =====
 async def main():
     """Main async function to start the bot"""
-    import sys
-    
     # Set up logging
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO
-    )
+    Utils.setup_logging()
     
     # Get configuration
     bot_token = os.environ.get('BOT_TOKEN')
     port = int(os.environ.get('PORT', 10000))
     
     if not bot_token:
-        print("❌ ERROR: BOT_TOKEN environment variable is required!")
-        print("💡 Please set BOT_TOKEN in your environment variables")
+        logger.error("BOT_TOKEN environment variable is required; set it in your environment")
         sys.exit(1)
     
-    # Auto-detect if we're in production (Render) or development
-    is_production = os.environ.get('RENDER') or os.environ.get('PORT')
+    # Webhooks by default; long polling only when asked for, e.g. on a dev machine
+    is_production = '--polling' not in sys.argv[1:]
     
-    print(f"🚀 Starting File Compilation Bot...")
-    print(f"🔑 Bot Token: {bot_token[:10]}...")
-    print(f"🌐 Mode: {'PRODUCTION (Webhook)' if is_production else 'DEVELOPMENT (Polling)'}")
-    print(f"🔧 Port: {port}")
+    # One write for the whole banner rather than a locked, encoded write per line
+    sys.stdout.write(
+        f"🚀 Starting File Compilation Bot...\n"
+        f"🔑 Bot Token: {bot_token[:10]}...\n"
+        f"🌐 Mode: {'PRODUCTION (Webhook)' if is_production else 'DEVELOPMENT (Polling)'}\n"
+        f"🔧 Port: {port}\n"
+    )
+    sys.stdout.flush()
     
     try:
         if is_production:
@@ -942,8 +1939,15 @@ async def main():
             await run_polling()
             
     except Exception as e:
-        print(f"❌ Failed to start bot: {e}")
+        logger.error("Failed to start bot: %s", e)
         raise
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    # uvloop is a faster drop-in event loop where available (not on Windows);
+    # uvloop.run sets it up for this run without touching the global loop policy
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())